@@ -2,9 +2,12 @@
 
 import os
 from dataclasses import dataclass
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
 import itertools
 from lxml import etree
 import copy
+import shutil
 import zipfile
 import pathlib
 from pathlib import Path
@@ -24,41 +27,45 @@ PITCH, PITCH CLASS, AND TPC AS USED IN MUSESCORE
  '''
 
 
-TPC_NAMES = ["C♭♭","G♭♭","D♭♭","A♭♭","E♭♭","B♭♭", "F♭","C♭","G♭",
+TPC_NAMES = ("C♭♭","G♭♭","D♭♭","A♭♭","E♭♭","B♭♭", "F♭","C♭","G♭",
              "D♭","A♭","E♭","B♭","F","C","G","D","A","E","B",
              "F♯","C♯","G♯","D♯","A♯","E♯","B♯", "F♯♯","C♯♯",
-             "G♯♯","D♯♯","A♯♯","E♯♯","B♯♯","F♭♭"];
-CHORD_INTERVALS_BY_MARKING = {"M": [4,7], "m": [3,7], "7": [4,10], "d": [3,9]};
-CHORD_SUFFIX_BY_MARKING =  {"M": "", "m": "m", "7": "⁷", "d": "°"};
+             "G♯♯","D♯♯","A♯♯","E♯♯","B♯♯","F♭♭");
+# Chord intervals and name suffix for each chord type marking.
+CHORD_BY_MARKING = {"M": ((4,7), ""), "m": ((3,7), "m"), "7": ((4,10), "⁷"),
+                    "d": ((3,9), "°")};
+
+# XPath expressions are compiled once here rather than re-parsed on every
+# call to xpath().
+_XP_PART_STAFF = etree.XPath(".//Part/Staff")
+_XP_SCORE_STAFF = etree.XPath(".//Score/Staff")
+_XP_SHOW_INVISIBLE = etree.XPath(".//Score/showInvisible")
+_XP_DEFAULT_CLEF = etree.XPath("defaultClef")
+
+# Parser shared by all .mscx reads; MuseScore doesn't use xml:id, so there is
+# no need to build an ID table.
+_MSCX_PARSER = etree.XMLParser(remove_blank_text=True, collect_ids=False)
+
+# MuseScore reads unindented .mscx just fine, and skipping the indentation
+# makes serializing cheaper. Set PAVIA_PRETTY=1 to get readable output.
+PRETTY = os.environ.get("PAVIA_PRETTY", "").lower() not in ("", "0", "false")
+
+# zlib level used when writing the transformed .mscx back into the archive;
+# 3 is much faster than the default 6 for a slightly larger file. It affects
+# only the .mscx: the other members are recompressed at zlib's default level.
+COMPRESSLEVEL = int(os.environ.get("PAVIA_COMPRESSLEVEL", "3"))
 
 def dump(xml):
     print(etree.tostring(xml, pretty_print=True))
 
-def scrub(root, path):
-    for node in root.xpath(path):
-        node.getparent().remove(node)
-    
 class Transform:
-    '''Describes a transformation to be applied to each of the files
-    contained in the .mscz zip archives.'''
+    '''Describes a transformation to be applied to the .mscx score file
+    contained in the .mscz zip archives. The other archive members are
+    copied across unchanged and never passed to a transform.'''
 
     def process(self, path, content):
-        '''Given the name of a file inside the archive and its old contents,
-        return its new contents.'''
-        return content
-    
-class MultiTransform(Transform):
-    '''Perform several transforms sequentially.'''
-    
-    def __init__(self):
-        self.transforms = []
-
-    def add(self, transform):
-        self.transforms.append(transform)
-
-    def process(self, path, content):
-        for transform in self.transforms:
-            content = transform.process(path, content)
+        '''Given the name of the .mscx file inside the archive and its old
+        contents, return its new contents.'''
         return content
     
 class MscxTransform(Transform):
@@ -71,26 +78,39 @@ class MscxTransform(Transform):
     def process(self, path, content):
         if not path.endswith(".mscx"):
             return content
-        parser = etree.XMLParser(remove_blank_text=True)
-        self.root = etree.XML(content, parser)
+        self.root = etree.XML(content, _MSCX_PARSER)
         self.modify()
-        return etree.tostring(self.root, pretty_print=True, xml_declaration=True)
+        return etree.tostring(self.root, pretty_print=PRETTY,
+                              xml_declaration=True, encoding="UTF-8")
+
+class MscxPipeline(MscxTransform):
+    '''Perform several MscxTransforms sequentially on a single parsed
+    tree, rather than serializing and reparsing the .mscx between them.'''
+
+    def __init__(self):
+        self.transforms = []
+
+    def add(self, transform):
+        self.transforms.append(transform)
+
+    def modify(self):
+        for transform in self.transforms:
+            transform.root = self.root
+            transform.modify()
 
 class FixBrackets(MscxTransform):
     '''Set up bar lines and brackets to go all the way across each system.'''
     
     def modify(self):
-        staff_nodes = self.root.xpath(".//Part/Staff")
-        scrub(self.root, ".//Part/Staff/barLineSpan")
-        scrub(self.root, ".//Part/Staff/bracket")
+        staff_nodes = _XP_PART_STAFF(self.root)
+        for node in staff_nodes:
+            for child in node.findall("barLineSpan") + node.findall("bracket"):
+                node.remove(child)
         for node in staff_nodes[:1]:
-              bracket_node = etree.SubElement(node, "bracket")
-              bracket_node.attrib["type"] = "1"
-              bracket_node.attrib["span"] = str(len(staff_nodes))
-              bracket_node.attrib["col"] = "0"
+              etree.SubElement(node, "bracket", type="1",
+                               span=f"{len(staff_nodes)}", col="0")
         for node in staff_nodes[:-1]:
-              bar_line_span_node = etree.SubElement(node, "barLineSpan")
-              bar_line_span_node.text = "1"
+              etree.SubElement(node, "barLineSpan").text = "1"
         
     
 class CopyStaffTransform(MscxTransform):
@@ -101,18 +121,20 @@ class CopyStaffTransform(MscxTransform):
         self.tgt = tgt
 
     def modify(self):
-        src_node = self.root.xpath(".//Part/Staff")[self.src]
+        staff_nodes = _XP_PART_STAFF(self.root)
+        src_node = staff_nodes[self.src]
         assert int(src_node.attrib["id"]) == self.src + 1
-        assert len(self.root.xpath(".//Part/Staff")) == self.tgt
+        assert len(staff_nodes) == self.tgt
         tgt_node = copy.deepcopy(src_node)
-        tgt_node.attrib["id"] = str(self.tgt+1)
+        tgt_node.attrib["id"] = f"{self.tgt+1}"
         src_node.addnext(tgt_node)
 
-        src_node = self.root.xpath(".//Score/Staff")[self.src]
+        staff_nodes = _XP_SCORE_STAFF(self.root)
+        src_node = staff_nodes[self.src]
         assert int(src_node.attrib["id"]) == self.src + 1        
-        assert len(self.root.xpath(".//Score/Staff")) == self.tgt
+        assert len(staff_nodes) == self.tgt
         tgt_node = copy.deepcopy(src_node)
-        tgt_node.attrib["id"] = str(self.tgt+1)
+        tgt_node.attrib["id"] = f"{self.tgt+1}"
         src_node.addnext(tgt_node)
         
     
@@ -124,10 +146,11 @@ class CopyClefTransform(MscxTransform):
         self.tgt = tgt
         
     def modify(self):    
-        src_node = self.root.xpath(".//Part/Staff")[self.src]
+        staff_nodes = _XP_PART_STAFF(self.root)
+        src_node = staff_nodes[self.src]
         assert int(src_node.attrib["id"]) == self.src + 1
-        tgt_node = self.root.xpath(".//Part/Staff")[self.tgt]
-        src_clef = src_node.xpath("defaultClef")[0]
+        tgt_node = staff_nodes[self.tgt]
+        src_clef = _XP_DEFAULT_CLEF(src_node)[0]
         tgt_clef = copy.deepcopy(src_clef)
         tgt_node.append(tgt_clef)
         
@@ -139,11 +162,11 @@ class MuteStaffTransform(MscxTransform):
         self.idx = idx
         
     def modify(self):
-        staff_node = self.root.xpath(f".//Score/Staff")[self.idx]
-        for note_node in staff_node.xpath(".//Note"):
-            scrub(note_node, ".//play")
-            play_node = etree.SubElement(note_node, "play")
-            play_node.text = "0"
+        staff_node = _XP_SCORE_STAFF(self.root)[self.idx]
+        for note_node in staff_node.iter("Note"):
+            for play_node in list(note_node.iter("play")):
+                play_node.getparent().remove(play_node)
+            etree.SubElement(note_node, "play").text = "0"
 
 class HideStaffTransform(MscxTransform):
     '''Mark a given staff as not visible.'''
@@ -152,10 +175,10 @@ class HideStaffTransform(MscxTransform):
         self.idx = idx
         
     def modify(self):
-        staff_node = self.root.xpath(f".//Part/Staff")[self.idx]
-        scrub(staff_node, ".//isStaffVisible")
-        show_node = etree.SubElement(staff_node, "isStaffVisible")
-        show_node.text = "0"
+        staff_node = _XP_PART_STAFF(self.root)[self.idx]
+        for child in staff_node.findall("isStaffVisible"):
+            staff_node.remove(child)
+        etree.SubElement(staff_node, "isStaffVisible").text = "0"
             
 class Chord:
     '''Operations on a <Chord> node from the original score (in Pavia
@@ -166,49 +189,55 @@ class Chord:
     '''
     
     def __init__(self, chord_node):
-        self.chord_intervals = []
+        self.chord_intervals = ()
         self.chord_suffix = ""
         self.pitches = set()
-        self.pitch_classes = set()
         self.tpc_by_pitch = {}
         self.marking_nodes = []
         self.counter_bass = False
 
+        # A single walk over the chord collects everything we need. Within
+        # each <Note>, MuseScore writes <pitch> before <tpc>, so a <tpc>
+        # belongs to the most recently seen pitch.
         fake_nodes = []
-        for articulation_subtype_node in chord_node.xpath(".//Articulation/subtype"):
-            if articulation_subtype_node.text.startswith("articTenuto"):
-                self.counter_bass = True
-                fake_nodes.append(articulation_subtype_node.getparent())
+        pitch = None
+        for node in chord_node.iter("Note", "subtype", "text", "pitch", "tpc"):
+            tag = node.tag
+            if tag == "Note":
+                pitch = None
+            elif tag == "subtype":
+                if (node.getparent().tag == "Articulation"
+                        and node.text.startswith("articTenuto")):
+                    self.counter_bass = True
+                    fake_nodes.append(node.getparent())
+            elif tag == "text":
+                if node.getparent().tag != "Fingering":
+                    continue
+                chord_type = CHORD_BY_MARKING.get(node.text)
+                if chord_type is not None:
+                    self.chord_intervals, self.chord_suffix = chord_type
+                    self.marking_nodes.append(node)
+            elif tag == "pitch":
+                pitch = int(node.text)
+                self.pitches.add(pitch)
+            elif pitch is not None:
+                self.tpc_by_pitch[pitch] = int(node.text)
         for fake_node in fake_nodes:
             fake_node.getparent().remove(fake_node)
-        for text_node in chord_node.xpath(".//Fingering/text"):
-            marking = text_node.text
-            if marking in CHORD_INTERVALS_BY_MARKING:
-                self.chord_intervals = CHORD_INTERVALS_BY_MARKING[marking]
-            if marking in CHORD_SUFFIX_BY_MARKING:
-                self.chord_suffix = CHORD_SUFFIX_BY_MARKING[marking]
-                self.marking_nodes.append(text_node)
-        for pitch_node in chord_node.findall(".//pitch"):
-            pitch = int(pitch_node.text)
-            pitch_class = pitch % 12
-            self.pitches.add(pitch)
-            self.pitch_classes.add(pitch_class)
-            for tpc_node in pitch_node.xpath("../tpc"):
-                self.tpc_by_pitch[pitch] = int(tpc_node.text)
 
 
-    @property
+    @cached_property
     def root_pitch(self):
         return max(self.pitches)
 
-    @property
+    @cached_property
     def root_tpc(self):
         return self.tpc_by_pitch[self.root_pitch]
 
-    @property
+    @cached_property
     def annotations(self):
         names = []
-        for pitch in sorted(list(self.pitches), reverse=True):
+        for pitch in sorted(self.pitches, reverse=True):
             tpc = self.tpc_by_pitch[pitch]
             name = TPC_NAMES[tpc]
             if self.chord_intervals and pitch == self.root_pitch:
@@ -226,9 +255,9 @@ class Chord:
         '''Stradella chord pitches that are not written in Pavia
         notation.'''
         for chord_interval in self.chord_intervals:
-            pitch = (self.root_pitch + chord_interval) % 12
-            while pitch <= 50:
-                pitch += 12
+            # Lowest pitch of this pitch class above 50.
+            pitch_class = (self.root_pitch + chord_interval) % 12
+            pitch = pitch_class + 12 * ((50 - pitch_class) // 12 + 1)
             if not pitch in self.pitches:
                 yield pitch
 
@@ -237,8 +266,7 @@ class Chord:
         note_nodes = []
         for pitch in self.extra_pitches:
             note_node = etree.Element("Note")
-            pitch_node = etree.SubElement(note_node, "pitch")
-            pitch_node.text = str(pitch)
+            etree.SubElement(note_node, "pitch").text = f"{pitch}"
             note_nodes.append(note_node)
         return note_nodes
 
@@ -246,22 +274,20 @@ class Chord:
     def extra_stafftext_nodes(self):
         for annotation in self.annotations:
             stafftext_node = etree.Element("StaffText")
-            placement_node = etree.SubElement(stafftext_node, "placement")
-            placement_node.text = "below"
+            etree.SubElement(stafftext_node, "placement").text = "below"
             text_node = etree.SubElement(stafftext_node, "text")                
             if annotation[0] == "_":
-                u_node = etree.SubElement(text_node, "u")
-                u_node.text = annotation[1:]
+                etree.SubElement(text_node, "u").text = annotation[1:]
             else:
                 text_node.text = annotation
             yield stafftext_node
 
 class Measure:
     @classmethod
-    def measures(cls, root):
+    def measures(cls, staff_nodes):
         measure_node_by_idx_by_staff = []
-        for staff_node in root.xpath(".//Score/Staff"):
-            measure_node_by_idx = staff_node.xpath("./Measure")
+        for staff_node in staff_nodes:
+            measure_node_by_idx = staff_node.findall("Measure")
             measure_node_by_idx_by_staff.append(measure_node_by_idx)
         measure_node_by_staff_by_idx = zip(*measure_node_by_idx_by_staff)
         return map(cls, measure_node_by_staff_by_idx)
@@ -274,59 +300,97 @@ class Measure:
 
     def voice(self, i, j):
         measure_node = self.node(i)
-        n = len(measure_node.xpath("./voice"))
-        for _ in range(4-n):
-            etree.SubElement(measure_node, "voice")
-        return measure_node.xpath("./voice")[j]
+        voice_nodes = measure_node.findall("voice")
+        for _ in range(4-len(voice_nodes)):
+            voice_nodes.append(etree.SubElement(measure_node, "voice"))
+        return voice_nodes[j]
+
+def has_chords(staff_node):
+    '''Whether the given staff contains any <Chord> at all. Rests-only
+    staves need no per-measure chord processing.'''
+    return next(staff_node.iter("Chord"), None) is not None
+
+class StaffChordTransform(MscxTransform):
+    '''A transform that works through the chords of one staff, a measure
+    at a time. To actually do something, override modify_measure().'''
 
-class GermanTransform(MscxTransform):
     def __init__(self, staff_id):
         self.staff_id = staff_id
-        
+
     def modify(self):
-        for measure in Measure.measures(self.root):
-            measure_node = measure.node(self.staff_id)
-            for chord_node in measure_node.xpath(".//Chord"):
-                chord = Chord(chord_node)
-                for extra_note_node in chord.extra_note_nodes:
-                    chord_node.append(extra_note_node)
-                for marking_node in chord.marking_nodes:
-                    marking_node.getparent().remove(marking_node)
-                for extra_stafftext_node in chord.extra_stafftext_nodes:
-                    chord_node.addprevious(extra_stafftext_node)
+        staff_nodes = _XP_SCORE_STAFF(self.root)
+        if not has_chords(staff_nodes[self.staff_id]):
+            return
+        for measure in Measure.measures(staff_nodes):
+            self.modify_measure(measure)
+
+    def modify_measure(self, measure):
+        pass
+
+class GermanTransform(StaffChordTransform):
+    def modify_measure(self, measure):
+        measure_node = measure.node(self.staff_id)
+        for chord_node in measure_node.iter("Chord"):
+            chord = Chord(chord_node)
+            for extra_note_node in chord.extra_note_nodes:
+                chord_node.append(extra_note_node)
+            for marking_node in chord.marking_nodes:
+                marking_node.getparent().remove(marking_node)
+            for extra_stafftext_node in chord.extra_stafftext_nodes:
+                chord_node.addprevious(extra_stafftext_node)
+
+class SymbolsTransform(StaffChordTransform):
+    def modify_measure(self, measure):
+        measure_node = measure.node(self.staff_id)
+        for chord_node in measure_node.iter("Chord"):
+            chord = Chord(chord_node)
+            for extra_stafftext_node in chord.extra_stafftext_nodes:
+                chord_node.addprevious(extra_stafftext_node)
+
+class ChordAnnotateTransform(MscxTransform):
+    '''A SymbolsTransform and a GermanTransform on different staves,
+    sharing a single walk over the measures. Either staff id may be None.'''
+
+    def __init__(self, symbols_staff_id, german_staff_id):
+        self.transforms = []
+        if symbols_staff_id is not None:
+            self.transforms.append(SymbolsTransform(symbols_staff_id))
+        if german_staff_id is not None:
+            self.transforms.append(GermanTransform(german_staff_id))
 
-class SymbolsTransform(MscxTransform):
-    def __init__(self, staff_id):
-        self.staff_id = staff_id
-        
     def modify(self):
-        for measure in Measure.measures(self.root):
-            measure_node = measure.node(self.staff_id)
-            for chord_node in measure_node.xpath(".//Chord"):
-                chord = Chord(chord_node)
-                for extra_stafftext_node in chord.extra_stafftext_nodes:
-                    chord_node.addprevious(extra_stafftext_node)
+        staff_nodes = _XP_SCORE_STAFF(self.root)
+        transforms = [transform for transform in self.transforms
+                      if has_chords(staff_nodes[transform.staff_id])]
+        if not transforms:
+            return
+        for measure in Measure.measures(staff_nodes):
+            for transform in transforms:
+                transform.modify_measure(measure)
 
 class HideInvisibleTransform(MscxTransform):
     def modify(self):
-        for show_invisible_node in self.root.xpath(".//Score/showInvisible"):
+        for show_invisible_node in _XP_SHOW_INVISIBLE(self.root):
             show_invisible_node.text = "0"
                     
 class CondensedTransform(MscxTransform):
     def modify(self):
-        for measure in Measure.measures(self.root):
+        for measure in Measure.measures(_XP_SCORE_STAFF(self.root)):
             self.expand_one_measure(measure)
 
     def expand_one_measure(self, measure):
         src_voice_node = measure.voice(1, 0)
         tgt_voice_node = measure.voice(0, 3)
-        for chord_node in src_voice_node.xpath("./Chord | ./Rest"):
-            dummy_rest_node = copy.deepcopy(chord_node)
-            scrub(dummy_rest_node,".//Note")
-            dummy_rest_node.tag = "Rest"
-            visible_node = etree.SubElement(dummy_rest_node, "visible")
-            visible_node.text="0"
-            tgt_voice_node.append(dummy_rest_node)
+        for chord_node in src_voice_node.iterchildren("Chord", "Rest"):
+            # Build the rest from the chord's non-note children (duration,
+            # dots, ...) instead of copying the whole chord and then
+            # stripping its notes back out.
+            dummy_rest_node = etree.SubElement(tgt_voice_node, "Rest",
+                                               chord_node.attrib)
+            for child_node in chord_node:
+                if child_node.tag != "Note":
+                    dummy_rest_node.append(copy.deepcopy(child_node))
+            etree.SubElement(dummy_rest_node, "visible").text = "0"
             if chord_node.tag == "Chord":
                 chord = Chord(chord_node)
                 for extra_stafftext_node in chord.extra_stafftext_nodes:
@@ -338,16 +402,26 @@ def zoop(src_path, src_tag, dst_tag, transform):
     src_stem = src_path.stem
     dst_stem = dst_tag + src_stem.removeprefix(src_tag)
     dst_path = src_path.with_stem(dst_stem)
-    src_zip = zipfile.ZipFile(src_path)
-    dst_zip = zipfile.ZipFile(dst_path, 'w')
-    for zip_info in src_zip.infolist():
-        content = src_zip.read(zip_info)
-        content = transform.process(zip_info.filename, content)
-        dst_zip.writestr(zip_info, content)
-    print(f"\t{dst_path}")
+    with zipfile.ZipFile(src_path) as src_zip, \
+         zipfile.ZipFile(dst_path, 'w') as dst_zip:
+        for zip_info in src_zip.infolist():
+            if not zip_info.filename.endswith(".mscx"):
+                # Thumbnails, audio etc. aren't transformed, so stream them
+                # across in chunks rather than holding them in memory. They
+                # are still decompressed and recompressed on the way.
+                with src_zip.open(zip_info) as src_file, \
+                     dst_zip.open(zip_info, 'w') as dst_file:
+                    shutil.copyfileobj(src_file, dst_file, 1 << 20)
+                continue
+            content = src_zip.read(zip_info)
+            content = transform.process(zip_info.filename, content)
+            # Entries keep their original compress_type, but a ZipInfo
+            # doesn't pick up the archive's compresslevel by itself.
+            dst_zip.writestr(zip_info, content, compresslevel=COMPRESSLEVEL)
+    return dst_path
 
 def german():
-    transform = MultiTransform()
+    transform = MscxPipeline()
     transform.add(CopyStaffTransform(1,2))
     transform.add(CopyClefTransform(1,2))
     transform.add(GermanTransform(2))
@@ -358,11 +432,10 @@ def german():
     return transform
 
 def american():
-    transform = MultiTransform()
+    transform = MscxPipeline()
     transform.add(CopyStaffTransform(1,2))
     transform.add(CopyClefTransform(1,2))
-    transform.add(SymbolsTransform(1))    
-    transform.add(GermanTransform(2))
+    transform.add(ChordAnnotateTransform(1, 2))
     transform.add(HideStaffTransform(2))
     transform.add(MuteStaffTransform(1))
     transform.add(FixBrackets())
@@ -370,7 +443,7 @@ def american():
     return transform
 
 def french():
-    transform = MultiTransform()
+    transform = MscxPipeline()
     transform.add(CopyStaffTransform(1,2))
     transform.add(CopyClefTransform(1,2))
     transform.add(GermanTransform(2))
@@ -381,8 +454,21 @@ def french():
     transform.add(HideInvisibleTransform())    
     return transform
 
-for path in pathlib.Path('.').glob("(pavia)*.mscz"):
-    print(path)
-    zoop(path, "(pavia)", "(german)", german())
-    zoop(path, "(pavia)", "(american)", american())
-    zoop(path, "(pavia)", "(french)", french())
+FORMATS = [("(german)", german), ("(american)", american), ("(french)", french)]
+
+def zoop_one(task):
+    '''Produce one output format for one score. Runs in a worker process,
+    so the transform is built there from its (picklable) factory.'''
+    src_path, dst_tag, make_transform = task
+    return zoop(src_path, "(pavia)", dst_tag, make_transform())
+
+if __name__ == "__main__":
+    paths = list(pathlib.Path('.').glob("(pavia)*.mscz"))
+    tasks = [(path, tag, make_transform)
+             for path in paths for tag, make_transform in FORMATS]
+    with ProcessPoolExecutor() as executor:
+        dst_paths = executor.map(zoop_one, tasks)
+        for path in paths:
+            print(path)
+            for _ in FORMATS:
+                print(f"\t{next(dst_paths)}")